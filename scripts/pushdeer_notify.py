@@ -3,13 +3,28 @@
 """
 PushDeer notification (human-friendly CN)
 
-- Reads outputs/latest/report.json and outputs/latest/diff.md
-- Generates a short Chinese summary
-- Sends via PushDeer
+- Reads outputs/latest/report.json (structured `changes`, no Markdown parsing)
+- Queues the run into a durable on-disk outbox (outputs/outbox/)
+- Coalesces all pending runs into ONE message, nets out their changes
+- Delivers via a pluggable transport, retrying with backoff;
+  on failure the outbox is kept so the alert is sent on a later run
+
+Env:
+- PUSHDEER_KEY                      : PushDeer push key (transport=pushdeer)
+- STRATASENSE_NOTIFY_TRANSPORT      : pushdeer (default) | stub
+- STRATASENSE_NOTIFY_MIN_INTERVAL   : seconds between two pushes (default 600)
+- STRATASENSE_NOTIFY_MAX_WAIT       : max seconds to wait out that interval
+                                      (default interval + 60; 0 on GitHub Actions)
+
+Args:
+- --flush-only : only deliver what is already queued (do not enqueue latest report)
+- STRATASENSE_NOTIFY_LAYERS         : per-layer policy override, e.g. "L4=notify,L2=digest"
 """
 
 import os
+import sys
 import json
+import contextlib
 import time
 import urllib.parse
 import urllib.request
@@ -18,10 +33,28 @@ from pathlib import Path
 ROOT = Path(__file__).resolve().parents[1]
 LATEST = ROOT / "outputs" / "latest"
 REPORT_JSON = LATEST / "report.json"
-DIFF_MD = LATEST / "diff.md"
+OUTBOX = ROOT / "outputs" / "outbox"
+PENDING = OUTBOX / "pending"
+OUTBOX_STATE = OUTBOX / "state.json"
+STUB_LOG = OUTBOX / "stub_sent.jsonl"
+FLUSH_LOCK = OUTBOX / "flush.lock"
 
 PUSHDEER_API = "https://api2.pushdeer.com/message/push"
 
+# 进程内重试（秒）；全部失败后留在 outbox，按指数退避等待下次运行
+RETRY_DELAYS = (2, 4, 8)
+BACKOFF_BASE = 300
+BACKOFF_MAX = 6 * 3600
+BODY_MAX = 3500
+LOCK_POLL = 5
+LOCK_STALE = 30 * 60
+
+# 分层通知策略（key 前缀 L1..L5）：
+#   notify : 变化会触发推送并列出明细
+#   digest : 不单独触发推送；随其他推送附带计数（L4 是反向指标，只提醒）
+#   mute   : 完全忽略
+LAYER_POLICY = {"L1": "notify", "L2": "notify", "L3": "notify", "L4": "digest", "L5": "mute"}
+
 
 def _read_text(p: Path) -> str:
     if not p.exists():
@@ -38,137 +71,413 @@ def _read_json(p: Path) -> dict:
         return {}
 
 
-def _parse_diff_sections(diff_md: str) -> dict:
+def _write_json_atomic(p: Path, obj) -> None:
+    # 先写临时文件再 rename：中途崩溃不会留下半截 JSON
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(p.name + ".tmp")
+    tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, p)
+
+
+# ---------------------------------------------------------------------------
+# outbox
+# ---------------------------------------------------------------------------
+
+
+def _layer_policy() -> dict:
+    pol = dict(LAYER_POLICY)
+    raw = os.environ.get("STRATASENSE_NOTIFY_LAYERS", "")
+    for item in raw.split(","):
+        layer, _, mode = item.partition("=")
+        layer, mode = layer.strip().upper(), mode.strip().lower()
+        if layer and mode in ("notify", "digest", "mute"):
+            pol[layer] = mode
+    return pol
+
+
+def _policy_of(key: str, pol: dict) -> str:
+    # 不带 L 前缀的旧 key 一律 notify
+    return pol.get(key.split(".", 1)[0], "notify")
+
+
+def split_by_policy(changes: dict, pol: dict) -> tuple[dict, dict]:
     """
-    Parse diff.md roughly:
-    expects headings: added / removed / changed / notes (optional)
+    -> (notify_changes, digest_changes); muted keys are dropped.
     """
-    lines = diff_md.splitlines()
-    sections = {"added": [], "removed": [], "changed": [], "notes": []}
-    cur = None
-    for ln in lines:
-        s = ln.strip()
-        if s.lower() in sections:
-            cur = s.lower()
-            continue
-        if cur is None:
-            continue
-        # bullet items like "- xxx" or "• xxx"
-        if s.startswith(("-", "•", "*")):
-            item = s.lstrip("-•*").strip()
-            if item:
-                sections[cur].append(item)
-        # plain "(none)" style
-        if s.lower() == "(none)":
-            # do nothing
+    out = {"notify": {}, "digest": {}}
+    for mode in out:
+        out[mode] = {"added": {}, "removed": {}, "changed": {}}
+    for sec in ("added", "removed", "changed"):
+        for k, v in (changes.get(sec, {}) or {}).items():
+            mode = _policy_of(k, pol)
+            if mode in out:
+                out[mode][sec][k] = v
+    for ch in out.values():
+        ch["has_change"] = bool(ch["added"] or ch["removed"] or ch["changed"])
+    return out["notify"], out["digest"]
+
+
+def _should_notify(report: dict) -> bool:
+    """
+    README 通知策略：有结构变化 → 通知；手动触发（meta.notify）→ 一定通知。
+    “结构变化”只看策略为 notify 的层。
+    """
+    meta = report.get("meta", {}) or {}
+    changes = report.get("changes", {}) or {}
+    if meta.get("notify"):
+        return True
+    if not changes.get("has_change"):
+        return False
+    notify_ch, _ = split_by_policy(changes, _layer_policy())
+    return notify_ch["has_change"]
+
+
+def enqueue(report: dict) -> bool:
+    """
+    Put one run into the outbox. Idempotent per run_id (re-running the
+    notifier for the same report does not queue it twice).
+    """
+    if not report or not _should_notify(report):
+        return False
+    meta = report.get("meta", {}) or {}
+    run_id = str(meta.get("run_id") or "run_unknown")
+    entry = {
+        "run_id": run_id,
+        "as_of": meta.get("as_of") or "",
+        "event": meta.get("event") or "",
+        "changes": report.get("changes", {}) or {},
+        "notes": report.get("notes", []) or [],
+        "queued_at": time.time(),
+    }
+    path = PENDING / f"{run_id}.json"
+    if path.exists():
+        return False
+    _write_json_atomic(path, entry)
+    return True
+
+
+def pending_entries() -> list:
+    if not PENDING.exists():
+        return []
+    out = []
+    for p in sorted(PENDING.glob("*.json")):
+        e = _read_json(p)
+        if e:
+            e["_path"] = str(p)
+            out.append(e)
+    # run_id = run_YYYYMMDD_HHMMSS，字典序即时间序
+    out.sort(key=lambda e: (e.get("run_id", ""), e.get("queued_at", 0)))
+    return out
+
+
+def _ack(entries: list) -> None:
+    for e in entries:
+        try:
+            Path(e["_path"]).unlink()
+        except FileNotFoundError:
             pass
-    return sections
 
 
-def _summarize_cn(report: dict, diff_sections: dict) -> tuple[str, str]:
+def merge_changes(entries: list) -> dict:
     """
-    Returns (title, body) in Chinese.
+    Fold the changes of several runs (oldest first) into one net diff:
+    value before the first run vs value after the last run.
+    A key added then removed (or changed back) drops out entirely.
     """
-    meta = report.get("meta", {}) if isinstance(report, dict) else {}
-    as_of = meta.get("as_of") or report.get("as_of") or ""
-    event = meta.get("event") or report.get("event") or ""
-    has_change = meta.get("has_change")
-    if has_change is None:
-        has_change = report.get("has_change")
-
-    # ★ 人话规则兜底：diff 全空 = 无变化
-    if has_change is None:
-        if (
-            len(diff_sections.get("added", [])) == 0
-            and len(diff_sections.get("removed", [])) == 0
-            and len(diff_sections.get("changed", [])) == 0
-        ):
-            has_change = False
-
-
-    # change counts
-    a = len(diff_sections.get("added", []))
-    r = len(diff_sections.get("removed", []))
-    c = len(diff_sections.get("changed", []))
-    notes = diff_sections.get("notes", [])
+    base: dict = {}
+    final: dict = {}
+    for e in entries:
+        ch = e.get("changes", {}) or {}
+        for k, v in (ch.get("added", {}) or {}).items():
+            base.setdefault(k, None)
+            final[k] = v
+        for k, v in (ch.get("removed", {}) or {}).items():
+            base.setdefault(k, v)
+            final[k] = None
+        for k, row in (ch.get("changed", {}) or {}).items():
+            row = row or {}
+            base.setdefault(k, row.get("old"))
+            final[k] = row.get("new")
+
+    added, removed, changed = {}, {}, {}
+    for k, old in base.items():
+        new = final.get(k)
+        if old is None and new is not None:
+            added[k] = new
+        elif old is not None and new is None:
+            removed[k] = old
+        elif old is not None and old != new:
+            changed[k] = {"old": old, "new": new}
+    return {
+        "has_change": bool(added or removed or changed),
+        "added": added,
+        "removed": removed,
+        "changed": changed,
+    }
+
+
+# ---------------------------------------------------------------------------
+# message
+# ---------------------------------------------------------------------------
+
+
+def _summarize_cn(entries: list) -> tuple[str, str]:
+    """
+    Returns (title, body) in Chinese for one or more coalesced runs.
+    """
+    ch, digest = split_by_policy(merge_changes(entries), _layer_policy())
+    last = entries[-1]
+    added = ch["added"]
+    removed = ch["removed"]
+    changed = ch["changed"]
+    a, r, c = len(added), len(removed), len(changed)
 
     # Title
-    if has_change is True:
+    if ch["has_change"]:
         title = f"StrataSense：发现变化（+{a}/-{r}/~{c}）"
-    elif has_change is False:
-        title = "StrataSense：无变化"
     else:
-        title = "StrataSense：扫描完成"
+        title = "StrataSense：无变化"
 
     # Body (human)
     parts = []
-    if as_of:
-        parts.append(f"时间：{as_of}")
-    if event:
-        parts.append(f"触发：{event}")
+    if last.get("as_of"):
+        parts.append(f"时间：{last['as_of']}")
+    events = []
+    for e in entries:
+        ev = e.get("event") or ""
+        if ev and ev not in events:
+            events.append(ev)
+    if events:
+        parts.append(f"触发：{'、'.join(events)}")
+    if len(entries) > 1:
+        parts.append(f"合并：{len(entries)} 次运行（{entries[0].get('run_id')} → {last.get('run_id')}）")
 
     # Main conclusion
-    if has_change is True:
+    if ch["has_change"]:
         parts.append(f"结果：有变化（新增 {a}，移除 {r}，变更 {c}）")
-        # include a few items for readability
-        def take(xs, n=5):
-            return xs[:n] if xs else []
+
+        def take(items, n=5):
+            return [f"{k}: {v}" for k, v in sorted(items.items())[:n]]
 
         if a:
-            parts.append("新增： " + "；".join(take(diff_sections["added"])))
+            parts.append("新增： " + "；".join(take(added)))
         if r:
-            parts.append("移除： " + "；".join(take(diff_sections["removed"])))
+            parts.append("移除： " + "；".join(take(removed)))
         if c:
-            parts.append("变更： " + "；".join(take(diff_sections["changed"])))
-    elif has_change is False:
-        parts.append("结果：没有检测到变化（本次只是例行扫描）")
+            rows = {k: f"{v.get('old')} -> {v.get('new')}" for k, v in changed.items()}
+            parts.append("变更： " + "；".join(take(rows)))
     else:
-        parts.append("结果：扫描完成（未提供 has_change 字段）")
+        parts.append("结果：没有检测到变化（本次只是例行扫描）")
 
-    # Notes / warnings (keep short)
+    if digest["has_change"]:
+        layers = sorted({k.split(".", 1)[0] for sec in ("added", "removed", "changed") for k in digest[sec]})
+        n = sum(len(digest[sec]) for sec in ("added", "removed", "changed"))
+        parts.append(f"提醒：{'、'.join(layers)} 另有 {n} 项变化（仅提醒，不采信）")
+
+    # Notes / warnings (keep short): 只看最近一次运行
+    notes = last.get("notes", []) or []
     if notes:
-        # compress typical ERR lines
-        show = notes[:5]
-        parts.append("备注： " + "；".join(show))
+        parts.append("备注： " + "；".join(notes[:5]))
 
     body = "\n".join(parts)
+    # avoid too long (PushDeer sometimes truncates)
+    if len(body) > BODY_MAX:
+        body = body[:BODY_MAX] + "\n\n（内容过长已截断）"
     return title, body
 
 
-def _pushdeer_send(key: str, title: str, body: str) -> None:
-    data = {
-        "pushkey": key,
-        "text": title,
-        "desp": body,
-        "type": "markdown",
-    }
-    encoded = urllib.parse.urlencode(data).encode("utf-8")
-    req = urllib.request.Request(PUSHDEER_API, data=encoded, method="POST")
-    with urllib.request.urlopen(req, timeout=20) as resp:
-        raw = resp.read().decode("utf-8", errors="replace")
-    # minimal validation
-    if '"success"' not in raw and '"code":0' not in raw:
-        raise RuntimeError(f"PushDeer response not OK: {raw[:200]}")
+# ---------------------------------------------------------------------------
+# transports
+# ---------------------------------------------------------------------------
+
+
+class PushDeerTransport:
+    name = "pushdeer"
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+
+    def send(self, title: str, body: str) -> None:
+        data = {
+            "pushkey": self.key,
+            "text": title,
+            "desp": body,
+            "type": "markdown",
+        }
+        encoded = urllib.parse.urlencode(data).encode("utf-8")
+        req = urllib.request.Request(PUSHDEER_API, data=encoded, method="POST")
+        with urllib.request.urlopen(req, timeout=20) as resp:
+            raw = resp.read().decode("utf-8", errors="replace")
+        # minimal validation
+        if '"success"' not in raw and '"code":0' not in raw:
+            raise RuntimeError(f"PushDeer response not OK: {raw[:200]}")
+
 
+class StubTransport:
+    """Local stand-in: appends messages to outputs/outbox/stub_sent.jsonl."""
 
-def main() -> int:
+    name = "stub"
+
+    def __init__(self, path: Path = STUB_LOG) -> None:
+        self.path = path
+
+    def send(self, title: str, body: str) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time(), "title": title, "body": body}, ensure_ascii=False) + "\n")
+
+
+def make_transport():
+    kind = (os.environ.get("STRATASENSE_NOTIFY_TRANSPORT") or "pushdeer").strip().lower()
+    if kind == "stub":
+        return StubTransport()
     key = os.environ.get("PUSHDEER_KEY", "").strip()
     if not key:
-        print("WARN: PUSHDEER_KEY missing, cannot notify")
-        return 0
+        return None
+    return PushDeerTransport(key)
 
-    report = _read_json(REPORT_JSON)
-    diff_md = _read_text(DIFF_MD)
-    diff_sections = _parse_diff_sections(diff_md) if diff_md else {"added": [], "removed": [], "changed": [], "notes": []}
 
-    title, body = _summarize_cn(report, diff_sections)
+# ---------------------------------------------------------------------------
+# delivery
+# ---------------------------------------------------------------------------
 
-    # avoid too long (PushDeer sometimes truncates)
-    if len(body) > 3500:
-        body = body[:3500] + "\n\n（内容过长已截断）"
 
-    _pushdeer_send(key, title, body)
-    print("OK: notified via PushDeer")
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _min_interval() -> float:
+    return _env_float("STRATASENSE_NOTIFY_MIN_INTERVAL", 600.0)
+
+
+def _max_wait() -> float:
+    # 本地：默认等满一个间隔，被攒下的运行本进程内送出
+    # GitHub Actions：每次运行独占 runner，等待期间不会有别的运行入队，
+    # 等也合并不了什么 -> 默认不等，返回 held，由下一次运行（每日保温）补发
+    default = 0.0 if os.environ.get("GITHUB_ACTIONS") == "true" else _min_interval() + 60
+    return _env_float("STRATASENSE_NOTIFY_MAX_WAIT", default)
+
+
+@contextlib.contextmanager
+def _flush_lock():
+    """
+    Only one notifier sends at a time; a concurrent one waits and then
+    finds its run already delivered (coalesced) or sends it itself.
+    """
+    OUTBOX.mkdir(parents=True, exist_ok=True)
+    try:
+        if time.time() - FLUSH_LOCK.stat().st_mtime > LOCK_STALE:
+            FLUSH_LOCK.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(FLUSH_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        yield False
+        return
+    try:
+        os.close(fd)
+        yield True
+    finally:
+        try:
+            FLUSH_LOCK.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _send_with_retry(transport, title: str, body: str, sleep=time.sleep) -> str:
+    """Returns "" on success, otherwise the last error."""
+    err = ""
+    for delay in (0,) + RETRY_DELAYS:
+        if delay:
+            sleep(delay)
+        try:
+            transport.send(title, body)
+            return ""
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+    return err
+
+
+def _send_batch(transport, entries: list, st: dict, now: float, sleep) -> str:
+    title, body = _summarize_cn(entries)
+    err = _send_with_retry(transport, title, body, sleep=sleep)
+    if err:
+        fails = int(st.get("fail_count", 0) or 0) + 1
+        st["fail_count"] = fails
+        st["next_attempt_at"] = now + min(BACKOFF_BASE * (2 ** (fails - 1)), BACKOFF_MAX)
+        st["last_error"] = err[:200]
+        _write_json_atomic(OUTBOX_STATE, st)
+        return "failed"
+
+    _ack(entries)
+    _write_json_atomic(OUTBOX_STATE, {"last_sent_at": now, "fail_count": 0, "last_batch": len(entries)})
+    return "sent"
+
+
+def flush(transport, sleep=time.sleep, clock=time.time) -> str:
+    """
+    Deliver every pending run as one coalesced message.
+    If the last push was less than MIN_INTERVAL ago, wait out the rest
+    in-process (up to MAX_WAIT) and send whatever has piled up by then.
+    Returns a short status: sent / empty / held / backoff / failed.
+    """
+    deadline = clock() + _max_wait()
+    while True:
+        if not pending_entries():
+            # 并发的另一个 notifier 已经把本次运行合并发出
+            return "empty"
+
+        now = clock()
+        st = _read_json(OUTBOX_STATE)
+        if now < float(st.get("next_attempt_at", 0) or 0):
+            return "backoff"
+        wait = _min_interval() - (now - float(st.get("last_sent_at", 0) or 0))
+        if wait > 0:
+            if now + wait > deadline:
+                return "held"
+            # 突发的手动运行：等到间隔结束，期间入队的运行一起合并发送
+            sleep(wait)
+            continue
+
+        with _flush_lock() as got:
+            if not got:
+                if clock() + LOCK_POLL > deadline:
+                    return "held"
+                sleep(LOCK_POLL)
+                continue
+            # 拿到锁后重新读取：等待期间可能已被别人发送或有新运行入队
+            entries = pending_entries()
+            if not entries:
+                return "empty"
+            st = _read_json(OUTBOX_STATE)
+            if clock() - float(st.get("last_sent_at", 0) or 0) < _min_interval():
+                continue
+            return _send_batch(transport, entries, st, clock(), sleep)
+
+
+def main(argv: list | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if "--flush-only" not in argv:
+        enqueue(_read_json(REPORT_JSON))
+
+    transport = make_transport()
+    if transport is None:
+        # 不丢消息：已入队，等有 key 的运行再发
+        print("WARN: PUSHDEER_KEY missing, cannot notify (queued)")
+        return 0
+
+    status = flush(transport)
+    if status == "sent":
+        print(f"OK: notified via {transport.name}")
+    elif status == "failed":
+        print("ERR: notify failed, kept in outbox")
+        return 1
+    elif status in ("held", "backoff"):
+        print(f"OK: notify {status}, kept in outbox")
     return 0
 
 
@@ -2,17 +2,26 @@ from __future__ import annotations
 
 import argparse
 import os
+import shutil
+import sys
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
+from .httpu import use_latency_book
 from .paths import ensure_dir, resolve_root
-from .iojson import read_json, write_json, write_text
-from .state import State
-from .report import build_report, render_diff_md, now_iso
+from .iojson import open_text, read_json, write_json
+from .state import State, match_prefix, parse_prefixes
+from .report import build_report, now_iso, write_diff_json, write_diff_md
 from .sensors.fred import default_series as fred_defaults, fetch_latest as fred_fetch
 from .sensors.eia import default_series as eia_defaults, fetch_latest as eia_fetch
-from .sensors.gdelt import default_queries as gdelt_defaults, fetch_counts as gdelt_fetch
+from .sensors.gdelt import (
+    StreamConfig as GdeltStreamConfig,
+    default_queries as gdelt_defaults,
+    fetch_aggregates as gdelt_stream,
+    fetch_counts as gdelt_fetch,
+    stream_keys as gdelt_stream_keys,
+)
 
 
 def _run_id() -> str:
@@ -29,36 +38,101 @@ def _load_prev_state(latest_dir: Path) -> State:
     return State.from_obj({"last": vals})
 
 
-def _collect_values() -> Tuple[Dict[str, float], List[str]]:
+def _collect_values(
+    layers: Optional[Sequence[str]] = None,
+    gdelt_max: int = 0,
+    prev: Optional[State] = None,
+) -> Tuple[Dict[str, float], List[str], Dict[str, str]]:
+    """
+    layers: key 前缀（L2 / L3.FRED ...）；只请求命中的 sensor 条目，None = 全部。
+    gdelt_max: >0 时开启 GDELT 流式聚合，每个 query 最多读取这么多篇文章。
+    prev: 上次 state；给出时 FRED 先查 updates，未更新的 series 直接沿用。
+    returns (values, notes, checked)：checked = 上次的 checked + 本次确认 / 抓取过的 FRED.<id>。
+    """
     notes: List[str] = []
     values: Dict[str, float] = {}
+    # 旧版的全目录 "FRED" 时间戳已被逐 series 的记录取代
+    checked: Dict[str, str] = {k: v for k, v in (prev.checked if prev else {}).items() if k != "FRED"}
+
+    fred_items = [s for s in fred_defaults() if match_prefix(s.key, layers)]
+    eia_items = [s for s in eia_defaults() if match_prefix(s.key, layers)]
+    gdelt_items = [q for q in gdelt_defaults() if match_prefix(q.key, layers)]
+    gdelt_stream_items = []
+    if gdelt_max > 0:
+        gdelt_stream_items = [
+            q for q in gdelt_defaults() if any(match_prefix(k, layers) for k in gdelt_stream_keys(q))
+        ]
 
     fred_key = (os.getenv("FRED_API_KEY") or "").strip()
     eia_key = (os.getenv("EIA_API_KEY") or "").strip()
 
-    if not fred_key:
-        notes.append("ERR: missing FRED_API_KEY")
-    else:
-        v, n = fred_fetch(fred_key, fred_defaults())
-        values.update(v)
-        notes.extend(n)
+    if fred_items:
+        if not fred_key:
+            notes.append("ERR: missing FRED_API_KEY")
+        else:
+            try:
+                v, n = fred_fetch(fred_key, fred_items, prev=prev.last if prev else None, checked=checked)
+                values.update(v)
+                notes.extend(n)
+            except Exception as e:
+                notes.append(f"FRED_ERR: {type(e).__name__}")
 
-    if not eia_key:
-        notes.append("ERR: missing EIA_API_KEY")
-    else:
-        v, n = eia_fetch(eia_key, eia_defaults())
-        values.update(v)
-        notes.extend(n)
+    if eia_items:
+        if not eia_key:
+            notes.append("ERR: missing EIA_API_KEY")
+        else:
+            try:
+                v, n = eia_fetch(eia_key, eia_items)
+                values.update(v)
+                notes.extend(n)
+            except Exception as e:
+                notes.append(f"EIA_ERR: {type(e).__name__}")
 
     # GDELT：无 key（失败也不阻塞）
-    try:
-        v, n = gdelt_fetch(gdelt_defaults())
-        values.update(v)
-        notes.extend(n)
-    except Exception as e:
-        notes.append(f"GDELT_ERR: {type(e).__name__}")
+    if gdelt_items:
+        try:
+            v, n = gdelt_fetch(gdelt_items)
+            values.update(v)
+            notes.extend(n)
+        except Exception as e:
+            notes.append(f"GDELT_ERR: {type(e).__name__}")
+
+    if gdelt_stream_items:
+        try:
+            v, n = gdelt_stream(gdelt_stream_items, GdeltStreamConfig(max_articles=gdelt_max))
+            # 一个 query 同时产出 L1 / L4 key：只保留选中的层
+            values.update({k: x for k, x in v.items() if match_prefix(k, layers)})
+            notes.extend(n)
+        except Exception as e:
+            notes.append(f"GDELT_STREAM_ERR: {type(e).__name__}")
+
+    return values, notes, checked
+
+
+def _catalog_keys(gdelt_max: int = 0) -> List[str]:
+    keys = [s.key for s in fred_defaults()] + [s.key for s in eia_defaults()]
+    for q in gdelt_defaults():
+        keys.append(q.key)
+        if gdelt_max > 0:
+            keys.extend(gdelt_stream_keys(q))
+    return keys
 
-    return values, notes
+
+def _unmatched(prefixes: Sequence[str], keys: Sequence[str]) -> List[str]:
+    return [p for p in prefixes if not any(match_prefix(k, [p]) for k in keys)]
+
+
+def _gdelt_max(args: argparse.Namespace) -> Tuple[int, List[str]]:
+    # CLI > ENV GDELT_STREAM_MAX > 0；坏值不致命，降级为关闭并记一条 note
+    if args.gdelt_stream is not None:
+        return max(0, args.gdelt_stream), []
+    raw = (os.getenv("GDELT_STREAM_MAX") or "").strip()
+    if not raw:
+        return 0, []
+    try:
+        return max(0, int(raw)), []
+    except ValueError:
+        return 0, [f"WARN: invalid GDELT_STREAM_MAX={raw!r}, streaming off"]
 
 
 def cmd_scan(args: argparse.Namespace) -> int:
@@ -69,9 +143,32 @@ def cmd_scan(args: argparse.Namespace) -> int:
     ensure_dir(latest)
     ensure_dir(runs)
 
+    gdelt_max, pre_notes = _gdelt_max(args)
+    layers = parse_prefixes(args.layer)
+    missing = _unmatched(layers, _catalog_keys(gdelt_max))
+    if layers and len(missing) == len(layers):
+        print(f"ERR: --layer {','.join(layers)} matches no sensor item")
+        return 2
     prev = _load_prev_state(latest)
-    values, notes = _collect_values()
-    cur = State(last=values)
+    # 上游延迟历史：超时 / 对冲重试按每个 host、endpoint 的分位数自适应
+    book = use_latency_book(out_root / "latency.json")
+    try:
+        values, notes, checked = _collect_values(
+            layers or None,
+            gdelt_max=gdelt_max,
+            prev=None if args.full else prev,
+        )
+    finally:
+        book.save()
+    checked = {**{k: v for k, v in prev.checked.items() if k != "FRED"}, **checked}
+    if layers:
+        # 选择性扫描：未选中的层原样沿用上一次 state，只 diff 选中的切片
+        carried = {k: v for k, v in prev.last.items() if not match_prefix(k, layers)}
+        cur = State(last={**carried, **values}, checked=checked)
+        prev_view, cur_view = prev.select(layers), State(last=values)
+    else:
+        cur = State(last=values, checked=checked)
+        prev_view, cur_view = prev, cur
 
     gh_event = (os.getenv("GITHUB_EVENT_NAME") or "").strip()
     notify = bool(args.force_notify) or (gh_event == "workflow_dispatch")
@@ -82,23 +179,95 @@ def cmd_scan(args: argparse.Namespace) -> int:
         "event": gh_event or "local",
         "notify": notify,
     }
+    if layers:
+        meta["layers"] = layers
 
-    rep = build_report(prev, cur, meta, notes)
-    diff_md = render_diff_md(rep)
+    notes = pre_notes + notes
+    if missing:
+        notes.append(f"WARN: --layer {','.join(missing)} matches no sensor item")
 
-    # 写 runs（归档）
+    rep = build_report(prev_view, cur_view, meta, notes)
+    # 写 runs（归档）；全部流式写文件，不在内存拼整篇
     write_json(runs / "state.json", cur.to_obj())
     write_json(runs / "report.json", {"meta": rep.meta, "values": rep.values, "notes": rep.notes, "changes": rep.changes})
-    write_text(runs / "diff.md", diff_md)
+    with open_text(runs / "diff.md") as fh:
+        write_diff_md(rep, fh, top_n=args.top)
+    with open_text(runs / "diff.json") as fh:
+        write_diff_json(rep, fh)
 
-    # 写 latest（指针）
-    write_json(latest / "state.json", cur.to_obj())
-    write_json(latest / "report.json", {"meta": rep.meta, "values": rep.values, "notes": rep.notes, "changes": rep.changes})
-    write_text(latest / "diff.md", diff_md)
+    # 写 latest（指针）：直接复制归档，不再序列化第二遍
+    for name in ("state.json", "report.json", "diff.md", "diff.json"):
+        shutil.copyfile(runs / name, latest / name)
 
     # 默认沉默：只输出必要 OK
     print(f"OK: {str((latest / 'report.json').as_posix())}")
     print(f"OK: {str((latest / 'diff.md').as_posix())}")
+    print(f"OK: {str((latest / 'diff.json').as_posix())}")
+    return 0
+
+
+def _run_states(out_root: Path) -> List[Tuple[str, State]]:
+    """(run_id, state) for every archived run, oldest first."""
+    runs_dir = out_root / "runs"
+    if not runs_dir.exists():
+        return []
+    out: List[Tuple[str, State]] = []
+    for d in sorted(runs_dir.iterdir()):
+        sp = d / "state.json"
+        if d.is_dir() and sp.exists():
+            out.append((d.name, State.from_obj(read_json(sp))))
+    return out
+
+
+def cmd_diff(args: argparse.Namespace) -> int:
+    root = resolve_root(args.root)
+    layers = parse_prefixes(args.layer)
+    runs = dict(_run_states(root / "outputs"))
+    order = sorted(runs)
+
+    new_id = args.run or (order[-1] if order else None)
+    if new_id not in runs:
+        print(f"ERR: run not found: {new_id}")
+        return 1
+    if args.against:
+        old_id = args.against
+    else:
+        older = [r for r in order if r < new_id]
+        old_id = older[-1] if older else None
+    if old_id is not None and old_id not in runs:
+        print(f"ERR: run not found: {old_id}")
+        return 1
+
+    prev = runs[old_id] if old_id else State(last={})
+    cur = runs[new_id]
+    if layers and _unmatched(layers, list(prev.last) + list(cur.last)) == layers:
+        print(f"ERR: --layer {','.join(layers)} matches no key in {new_id} / {old_id or '(empty)'}")
+        return 1
+    meta = {"as_of": now_iso(), "run_id": new_id, "event": f"diff {old_id or '(empty)'}", "notify": False}
+    if layers:
+        meta["layers"] = layers
+    rep = build_report(prev.select(layers), cur.select(layers), meta, [])
+    write_diff_md(rep, sys.stdout, top_n=args.top)
+    return 0
+
+
+def cmd_history(args: argparse.Namespace) -> int:
+    root = resolve_root(args.root)
+    layers = parse_prefixes(args.layer)
+    rows = _run_states(root / "outputs")
+    if args.limit:
+        rows = rows[-args.limit:]
+    hits = 0
+    for run_id, st in rows:
+        view = st.select(layers)
+        hits += len(view.last)
+        # 前缀索引分组输出：只对选中的切片按层排序
+        for _, keys in view.index().group():
+            for k in keys:
+                print(f"{run_id}\t{k}\t{view.last[k]}")
+    if layers and rows and not hits:
+        print(f"ERR: --layer {','.join(layers)} matches no key")
+        return 1
     return 0
 
 
@@ -109,8 +278,31 @@ def build_parser() -> argparse.ArgumentParser:
     s = sub.add_parser("scan", help="run weekly scan (FRED+EIA+GDELT) -> outputs/")
     s.add_argument("--root", default=None, help="root dir (CLI > ENV STRATASENSE_ROOT > CWD)")
     s.add_argument("--force-notify", action="store_true", help="manual trigger must notify (flag only recorded)")
+    s.add_argument("--layer", action="append", default=None, help="only scan these layers/prefixes (L2, L1,L3, L3.FRED)")
+    s.add_argument(
+        "--gdelt-stream",
+        type=int,
+        default=None,
+        help="GDELT streaming aggregates: max articles per query (0 = off; ENV GDELT_STREAM_MAX)",
+    )
+    s.add_argument("--full", action="store_true", help="skip update pre-filters (FRED series/updates), fetch every series")
+    s.add_argument("--top", type=int, default=0, help="diff.md: show at most N keys per section, changed by largest |delta| within each layer (0 = all; diff.json is always full)")
     s.set_defaults(func=cmd_scan)
 
+    d = sub.add_parser("diff", help="diff two archived runs (default: latest vs previous)")
+    d.add_argument("--root", default=None, help="root dir (CLI > ENV STRATASENSE_ROOT > CWD)")
+    d.add_argument("--layer", action="append", default=None, help="only these layers/prefixes")
+    d.add_argument("--run", default=None, help="run_id to inspect (default: latest)")
+    d.add_argument("--against", default=None, help="run_id to compare with (default: the one before --run)")
+    d.add_argument("--top", type=int, default=0, help="show at most N keys per section, changed by largest |delta| within each layer (0 = all)")
+    d.set_defaults(func=cmd_diff)
+
+    h = sub.add_parser("history", help="print archived values: run_id<TAB>key<TAB>value")
+    h.add_argument("--root", default=None, help="root dir (CLI > ENV STRATASENSE_ROOT > CWD)")
+    h.add_argument("--layer", action="append", default=None, help="only these layers/prefixes")
+    h.add_argument("--limit", type=int, default=0, help="only the last N runs")
+    h.set_defaults(func=cmd_history)
+
     return p
 
 
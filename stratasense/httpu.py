@@ -1,22 +1,235 @@
 from __future__ import annotations
 
 import json
+import math
+import os
+import socket
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
-from typing import Any, Dict, Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 自适应超时：timeout = clamp(p99 * K, FLOOR, CEIL)，p99 只取成功请求；样本不足时用 DEFAULT
+DEFAULT_TIMEOUT = 25.0
+TIMEOUT_K = 3.0
+TIMEOUT_FLOOR = 5.0
+TIMEOUT_CEIL = 60.0
+# 对冲重试：第一个请求超过 p95 * HEDGE_K 仍未返回，就并发再发一次（只对 GET）
+HEDGE_K = 1.5
+HEDGE_FLOOR = 1.0
+MIN_SAMPLES = 5
+MAX_SAMPLES = 64
+# 连续超时达到这么多次才放宽预算（每多一次翻倍，直到 CEIL）
+TIMEOUT_STREAK = 2
+# 限流严格的上游（GDELT 约 5 秒一次）：重复请求只会让两个都被限流
+NO_HEDGE_HOSTS = {"api.gdeltproject.org"}
+
+
+def _pct(xs: List[float], q: float) -> float:
+    """
+    Linearly interpolated percentile. q is capped at 1 - 1/n so a small
+    sample's tail estimate never collapses onto its single largest value.
+    """
+    s = sorted(xs)
+    if len(s) == 1:
+        return s[0]
+    q = min(q, 1.0 - 1.0 / len(s))
+    pos = q * (len(s) - 1)
+    lo = math.floor(pos)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (pos - lo)
+
+
+def _clamp(x: float, lo: float, hi: float) -> float:
+    return max(lo, min(hi, x))
+
+
+class LatencyBook:
+    """
+    Per-host and per-endpoint (host + path) latency / failure history.
+    Persisted as a small JSON file (outputs/latency.json) between runs;
+    path=None keeps it in memory only.
+    """
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, Dict[str, Any]]] = {"hosts": {}, "endpoints": {}}
+        if path is not None and path.exists():
+            try:
+                obj = json.loads(path.read_text(encoding="utf-8"))
+                for kind in self.stats:
+                    if isinstance(obj.get(kind), dict):
+                        self.stats[kind] = obj[kind]
+            except Exception:
+                pass
+
+    @staticmethod
+    def _keys(url: str) -> tuple[str, str]:
+        u = urllib.parse.urlsplit(url)
+        return u.netloc, u.netloc + u.path
+
+    def record(self, url: str, seconds: float, ok: bool, timed_out: bool = False) -> None:
+        """
+        Only successful latencies enter `samples`; failures and timeouts are
+        counted separately so a single hang or a fast 5xx cannot skew the
+        percentiles.
+        """
+        host, ep = self._keys(url)
+        with self._lock:
+            for kind, key in (("hosts", host), ("endpoints", ep)):
+                row = self.stats[kind].setdefault(key, {"samples": [], "ok": 0, "fail": 0, "timeouts": 0})
+                if ok:
+                    row["samples"] = (row["samples"] + [round(seconds, 3)])[-MAX_SAMPLES:]
+                    row["ok"] += 1
+                    row["timeout_streak"] = 0
+                else:
+                    row["fail"] += 1
+                    if timed_out:
+                        row["timeouts"] += 1
+                        row["timeout_streak"] = int(row.get("timeout_streak", 0)) + 1
+
+    def _row(self, url: str) -> Dict[str, Any]:
+        host, ep = self._keys(url)
+        with self._lock:
+            for kind, key in (("endpoints", ep), ("hosts", host)):
+                row = self.stats[kind].get(key) or {}
+                if len(row.get("samples") or []) >= MIN_SAMPLES:
+                    return {"samples": list(row["samples"]), "timeout_streak": int(row.get("timeout_streak", 0))}
+        return {}
+
+    def timeout_for(self, url: str) -> float:
+        row = self._row(url)
+        if not row:
+            return DEFAULT_TIMEOUT
+        t = _pct(row["samples"], 0.99) * TIMEOUT_K
+        # 单次超时不算数；连续超时才说明上游确实变慢，预算逐次翻倍
+        streak = row["timeout_streak"]
+        if streak >= TIMEOUT_STREAK:
+            t = max(t, TIMEOUT_FLOOR) * (2 ** (streak - TIMEOUT_STREAK + 1))
+        return round(_clamp(t, TIMEOUT_FLOOR, TIMEOUT_CEIL), 2)
+
+    def hedge_after(self, url: str) -> Optional[float]:
+        if self._keys(url)[0] in NO_HEDGE_HOSTS:
+            return None
+        row = self._row(url)
+        if not row:
+            return None
+        h = max(HEDGE_FLOOR, _pct(row["samples"], 0.95) * HEDGE_K)
+        return h if h < self.timeout_for(url) else None
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with self._lock:
+            tmp.write_text(json.dumps(self.stats, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+_book = LatencyBook()
+
+
+def use_latency_book(path: Optional[Path]) -> LatencyBook:
+    """Load (or start) the persistent latency history used by get_json."""
+    global _book
+    _book = LatencyBook(path)
+    return _book
+
+
+def _is_timeout(e: BaseException) -> bool:
+    if isinstance(e, (socket.timeout, TimeoutError)):
+        return True
+    return isinstance(e, urllib.error.URLError) and isinstance(e.reason, (socket.timeout, TimeoutError))
+
+
+def _get_once(
+    url: str, headers: Dict[str, str], timeout: float, book: LatencyBook, count_timeout: bool = True
+) -> str:
+    t0 = time.monotonic()
+    try:
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            raw = resp.read().decode("utf-8", errors="replace")
+    except Exception as e:
+        timed_out = _is_timeout(e)
+        if count_timeout or not timed_out:
+            book.record(url, time.monotonic() - t0, ok=False, timed_out=timed_out)
+        raise
+    book.record(url, time.monotonic() - t0, ok=True)
+    return raw
+
+
+def _get_hedged(url: str, headers: Dict[str, str], timeout: float, hedge: float, book: LatencyBook) -> str:
+    """
+    Timeouts of the individual attempts are not recorded: a hedged call that
+    runs out of time counts as one timeout for the endpoint, however many
+    requests it had in flight.
+    """
+    pool = ThreadPoolExecutor(max_workers=2)
+    t0 = time.monotonic()
+    try:
+        first = pool.submit(_get_once, url, headers, timeout, book, False)
+        done, _ = wait([first], timeout=hedge)
+        if done:
+            return first.result()
+        pending = {first, pool.submit(_get_once, url, headers, timeout, book, False)}
+        err: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    return f.result()
+                e = f.exception()
+                # 优先保留超时：重试逻辑按它判断
+                if err is None or _is_timeout(e):
+                    err = e
+        assert err is not None
+        raise err
+    except Exception as e:
+        if _is_timeout(e):
+            book.record(url, time.monotonic() - t0, ok=False, timed_out=True)
+        raise
+    finally:
+        # 落后的那个请求自己会在 timeout 内结束，不等它
+        pool.shutdown(wait=False)
 
 
 def get_json(
     url: str,
     params: Optional[Dict[str, Any]] = None,
     headers: Optional[Dict[str, str]] = None,
-    timeout: int = 25,
+    timeout: Optional[float] = None,
 ) -> Dict[str, Any]:
+    """
+    timeout=None -> derived from the latency history of this endpoint / host
+    (with a hedged second request once the endpoint is known), and a timed-out
+    request is retried once at TIMEOUT_CEIL before giving up; an explicit
+    timeout disables all three.
+    """
     if params:
         q = urllib.parse.urlencode({k: v for k, v in params.items() if v is not None}, doseq=True)
         url = url + ("&" if "?" in url else "?") + q
 
-    req = urllib.request.Request(url, headers=headers or {})
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        raw = resp.read().decode("utf-8", errors="replace")
+    book = _book
+    if timeout is not None:
+        raw = _get_once(url, headers or {}, timeout, book)
+    else:
+        t = book.timeout_for(url)
+        hedge = book.hedge_after(url)
+        try:
+            if hedge is not None:
+                raw = _get_hedged(url, headers or {}, t, hedge, book)
+            else:
+                raw = _get_once(url, headers or {}, t, book)
+        except Exception as e:
+            # 历史预算可能偏紧（下限只有 5s）：超时后按上限再试一次，才算真正失败
+            if not _is_timeout(e) or t >= TIMEOUT_CEIL:
+                raise
+            raw = _get_once(url, headers or {}, TIMEOUT_CEIL, book)
     return json.loads(raw)
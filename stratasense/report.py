@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+import heapq
+import json
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Any, Dict, List
+from typing import Any, Dict, List, TextIO
 
-from .state import State, diff_state
+from .state import KeyIndex, State, diff_by_layer
+
+SECTIONS = ("added", "removed", "changed")
 
 
 def now_iso() -> str:
@@ -20,55 +24,128 @@ class Report:
 
 
 def build_report(prev: State, cur: State, meta: Dict[str, Any], notes: List[str]) -> Report:
-    added, removed, changed = diff_state(prev, cur)
+    added: Dict[str, float] = {}
+    removed: Dict[str, float] = {}
+    changed: Dict[str, Any] = {}
+    by_layer: Dict[str, Dict[str, int]] = {}
+    for layer, (a, r, c) in diff_by_layer(prev, cur).items():
+        added.update(a)
+        removed.update(r)
+        changed.update({k: {"old": ov, "new": nv} for k, (ov, nv) in c.items()})
+        by_layer[layer] = {"added": len(a), "removed": len(r), "changed": len(c)}
     has_change = bool(added or removed or changed)
     changes = {
         "has_change": has_change,
         "added": added,
         "removed": removed,
-        "changed": {k: {"old": ov, "new": nv} for k, (ov, nv) in changed.items()},
+        "changed": changed,
+        "by_layer": by_layer,
     }
     return Report(meta=meta, values=cur.last, notes=notes, changes=changes)
 
 
-def render_diff_md(rep: Report) -> str:
+def _delta(row: Any) -> float:
+    row = row or {}
+    try:
+        return abs(float(row.get("new")) - float(row.get("old")))
+    except Exception:
+        return 0.0
+
+
+def _pick(section: str, items: Dict[str, Any], top_n: int) -> List[str]:
+    """
+    Keys to show for one section. top_n <= 0 -> all.
+    changed: largest |new - old| first; added / removed: first by key.
+    heapq keeps this O(n log N) instead of a full sort.
+    """
+    if top_n <= 0 or len(items) <= top_n:
+        return list(items)
+    if section == "changed":
+        return heapq.nlargest(top_n, items, key=lambda k: _delta(items[k]))
+    return heapq.nsmallest(top_n, items)
+
+
+def _fmt_line(section: str, k: str, v: Any) -> str:
+    if section == "changed":
+        row = v or {}
+        return f"- {k}: {row.get('old')} -> {row.get('new')}"
+    return f"- {k}: {v}"
+
+
+def write_diff_md(rep: Report, fh: TextIO, top_n: int = 0) -> None:
+    """
+    Stream diff.md to `fh` line by line, grouped by layer.
+    top_n > 0 truncates each section and states how many were left out;
+    a truncated `changed` section lists the largest |new - old| first
+    within each layer.
+    """
     ch = rep.changes
-    lines: List[str] = []
-    lines.append("# StrataSense diff")
-    lines.append("")
-    lines.append(f"- as_of: {rep.meta.get('as_of')}")
-    lines.append(f"- run_id: {rep.meta.get('run_id')}")
-    lines.append(f"- event: {rep.meta.get('event')}")
-    lines.append(f"- notify: {rep.meta.get('notify')}")
-    lines.append(f"- has_change: {ch.get('has_change')}")
-    lines.append("")
-
-    def section(title: str, body_lines: List[str]) -> None:
-        lines.append(f"## {title}")
-        if not body_lines:
-            lines.append("(none)")
-        else:
-            lines.extend(body_lines)
-        lines.append("")
-
-    # added
-    added = ch.get("added", {}) or {}
-    section("added", [f"- {k}: {v}" for k, v in sorted(added.items())])
-
-    # removed
-    removed = ch.get("removed", {}) or {}
-    section("removed", [f"- {k}: {v}" for k, v in sorted(removed.items())])
-
-    # changed
-    changed = ch.get("changed", {}) or {}
-    changed_lines: List[str] = []
-    for k in sorted(changed.keys()):
-        row = changed[k] or {}
-        changed_lines.append(f"- {k}: {row.get('old')} -> {row.get('new')}")
-    section("changed", changed_lines)
+    w = fh.write
+    w("# StrataSense diff\n\n")
+    w(f"- as_of: {rep.meta.get('as_of')}\n")
+    w(f"- run_id: {rep.meta.get('run_id')}\n")
+    w(f"- event: {rep.meta.get('event')}\n")
+    w(f"- notify: {rep.meta.get('notify')}\n")
+    w(f"- has_change: {ch.get('has_change')}\n")
+    if rep.meta.get("layers"):
+        w(f"- layers: {', '.join(rep.meta['layers'])}\n")
+    w("\n")
+
+    for sec in SECTIONS:
+        items = ch.get(sec, {}) or {}
+        w(f"## {sec}\n")
+        if not items:
+            w("(none)\n\n")
+            continue
+        shown = _pick(sec, items, top_n)
+        if len(shown) < len(items):
+            w(f"(showing {len(shown)} of {len(items)})\n")
+        # 按 L1..L5 分组；截断的 changed 在组内保持 |delta| 从大到小，其余按 key 排序
+        by_delta = sec == "changed" and len(shown) < len(items)
+        for layer, keys in KeyIndex(shown).group(sort=not by_delta):
+            w(f"### {layer}\n")
+            for k in keys:
+                w(_fmt_line(sec, k, items[k]) + "\n")
+        w("\n")
 
     # notes
     if rep.notes:
-        section("notes", [f"- {n}" for n in rep.notes])
+        w("## notes\n")
+        for n in rep.notes:
+            w(f"- {n}\n")
+        w("\n")
+
+
+def write_diff_json(rep: Report, fh: TextIO) -> None:
+    """
+    Stream diff.json to `fh`, one entry per line (no intermediate document):
+
+      {"meta": ..., "has_change": ..., "summary": {sec: {"total", "by_layer"}},
+       "added": {k: v}, "removed": {k: v}, "changed": {k: {"old", "new"}}, "notes": [...]}
+    """
+    ch = rep.changes
+    dumps = lambda o: json.dumps(o, ensure_ascii=False)  # noqa: E731
+
+    summary: Dict[str, Any] = {}
+    for sec in SECTIONS:
+        summary[sec] = {
+            "total": len(ch.get(sec, {}) or {}),
+            "by_layer": {l: c.get(sec, 0) for l, c in (ch.get("by_layer", {}) or {}).items() if c.get(sec, 0)},
+        }
+
+    w = fh.write
+    w("{\n")
+    w(f' "meta": {dumps(rep.meta)},\n')
+    w(f' "has_change": {dumps(bool(ch.get("has_change")))},\n')
+    w(f' "summary": {dumps(summary)},\n')
+    for sec in SECTIONS:
+        items = ch.get(sec, {}) or {}
+        w(f' {dumps(sec)}: {{')
+        sep = "\n"
+        for k, v in items.items():
+            w(f"{sep}  {dumps(k)}: {dumps(v)}")
+            sep = ",\n"
+        w("\n },\n" if items else "},\n")
+    w(f' "notes": {dumps(rep.notes)}\n')
+    w("}\n")
 
-    return "\n".join(lines)
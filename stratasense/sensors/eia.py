@@ -33,7 +33,11 @@ def fetch_latest(api_key: str, items: List[EiaSeries]) -> Tuple[Dict[str, float]
         for k, v in (s.facets or {}).items():
             params[f"facets[{k}][]"] = v
 
-        j = get_json(url, params=params)
+        try:
+            j = get_json(url, params=params)
+        except Exception as e:
+            notes.append(f"EIA:{s.route} fetch failed ({type(e).__name__})")
+            continue
         data = (j.get("response") or {}).get("data") or []
 
         v: Optional[float] = None
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import math
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 from ..httpu import get_json
 
@@ -12,16 +13,137 @@ class FredSeries:
     key: str
     series_id: str
     label: str
+    # series/updates 的 filter_value：macro / regional；空 = 未知，永远直接抓取
+    feed: str = ""
+
+
+# series/updates 只覆盖最近约两周；更早的上次扫描 -> 全量抓取
+UPDATES_LOOKBACK = timedelta(days=13)
+# FRED 的 start_time 以美国中部时间解释：多留一天余量，宁可多抓
+UPDATES_MARGIN = timedelta(days=1)
+UPDATES_PAGE = 1000
+UPDATES_MAX_PAGES = 20
+# 单个更新流一周（+1 天余量）的典型页数；目录不比它大时预查不可能省请求
+UPDATES_EXPECTED_PAGES = 3
+# 沿用上限：距上次真正抓取 observations 超过这么久，无论更新流怎么说都重抓
+MAX_CARRY_AGE = timedelta(days=28)
+FEEDS = ("macro", "regional")
 
 
 def _iso(d: datetime) -> str:
     return d.strftime("%Y-%m-%d")
 
 
-def fetch_latest(api_key: str, items: List[FredSeries]) -> Tuple[Dict[str, float], List[str]]:
+def _parse_last_updated(s: str) -> Optional[datetime]:
+    # "2013-07-31 09:21:57-05" -> aware datetime
+    s = (s or "").strip()
+    if len(s) >= 3 and s[-3] in "+-" and s[-2:].isdigit():
+        s = s + "00"
+    try:
+        return datetime.strptime(s, "%Y-%m-%d %H:%M:%S%z")
+    except ValueError:
+        return None
+
+
+def _ts(d: datetime) -> str:
+    return d.isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+def _parse_ts(s: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat((s or "").replace("Z", "+00:00")).astimezone(timezone.utc)
+    except ValueError:
+        return None
+
+
+def updated_since(api_key: str, since: datetime, wanted: Dict[str, Set[str]]) -> Tuple[Optional[Set[str]], str]:
+    """
+    Bulk pre-pass over fred/series/updates (newest first, 1000 per page):
+    which of the `wanted` series ids (feed -> ids) were updated after `since`.
+    Each feed is queried with its own filter_value.
+
+    Each page costs one request, so the pre-pass only pays off while pages
+    spent < number of series. Returns (None, reason) when it cannot answer
+    within that budget (or `since` is outside the feed), with reason "" when
+    the catalog is too small to bother; the caller then fetches everything.
+    """
+    now = datetime.now(timezone.utc)
+    feeds = {f: ids for f, ids in wanted.items() if ids}
+    total = sum(len(ids) for ids in feeds.values())
+    if not feeds or total <= UPDATES_EXPECTED_PAGES * len(feeds):
+        # 预期内的跳过（目录太小）：静默全量，不记 note
+        return None, ""
+    if now - since > UPDATES_LOOKBACK:
+        return None, "last fetch older than updates window"
+
+    budget = min(UPDATES_MAX_PAGES, total)
+    spent = 0
+    base = "https://api.stlouisfed.org/fred/series/updates"
+    start = since - UPDATES_MARGIN
+    hit: Set[str] = set()
+    for feed, ids in feeds.items():
+        page = 0
+        while True:
+            if spent >= budget:
+                return None, f"updates feeds not exhausted within {budget} pages"
+            j = get_json(
+                base,
+                {
+                    "api_key": api_key,
+                    "file_type": "json",
+                    "filter_value": feed,
+                    "start_time": start.strftime("%Y%m%d%H%M"),
+                    "end_time": now.strftime("%Y%m%d%H%M"),
+                    "limit": UPDATES_PAGE,
+                    "offset": page * UPDATES_PAGE,
+                },
+            )
+            spent += 1
+            if page == 0:
+                try:
+                    pages = math.ceil(int(j.get("count")) / UPDATES_PAGE)
+                except (TypeError, ValueError):
+                    pages = 0
+                if spent - 1 + pages > budget:
+                    return None, f"{feed} updates feed needs {pages} pages > budget {budget - spent + 1}"
+            rows = j.get("seriess", []) or []
+            oldest: Optional[datetime] = None
+            for r in rows:
+                sid = r.get("id")
+                lu = _parse_last_updated(r.get("last_updated", ""))
+                if lu is None:
+                    # 看不懂时间戳：保守地算作已更新
+                    if sid in ids:
+                        hit.add(sid)
+                    continue
+                oldest = lu if oldest is None or lu < oldest else oldest
+                if sid in ids and lu >= start:
+                    hit.add(sid)
+            # 按 last_updated 倒序：本页已早于窗口或已到末页 -> 该流结束
+            if len(rows) < UPDATES_PAGE or (oldest is not None and oldest < start):
+                break
+            page += 1
+    return hit, ""
+
+
+def fetch_latest(
+    api_key: str,
+    items: List[FredSeries],
+    prev: Optional[Dict[str, float]] = None,
+    checked: Optional[Dict[str, str]] = None,
+) -> Tuple[Dict[str, float], List[str]]:
     """
     Pull latest numeric observation within recent window.
     Output is STRUCTURAL values, not signals.
+
+    With `prev` + `checked` (State.checked), a series may be carried forward
+    from `prev` without an observations request when:
+      - its feed (macro / regional) is known,
+      - the updates feed shows no update since it was last confirmed
+        (checked["FRED.<id>"]), and
+      - its observations were fetched within MAX_CARRY_AGE
+        (checked["FRED.<id>.fetched"]).
+    `checked` is updated in place for every series confirmed or fetched.
     """
     notes: List[str] = []
     out: Dict[str, float] = {}
@@ -29,19 +151,61 @@ def fetch_latest(api_key: str, items: List[FredSeries]) -> Tuple[Dict[str, float
     base = "https://api.stlouisfed.org/fred/series/observations"
     now = datetime.now(timezone.utc)
     start = now - timedelta(days=21)
+    stamp = _ts(now)
+
+    if prev and checked is not None:
+        cands: List[FredSeries] = []
+        for s in items:
+            confirmed = _parse_ts(checked.get(f"FRED.{s.series_id}"))
+            fetched = _parse_ts(checked.get(f"FRED.{s.series_id}.fetched"))
+            if (
+                s.feed in FEEDS
+                and s.key in prev
+                and confirmed is not None
+                and fetched is not None
+                and now - fetched <= MAX_CARRY_AGE
+            ):
+                cands.append(s)
+        changed: Optional[Set[str]] = None
+        if cands:
+            since = min(_parse_ts(checked[f"FRED.{s.series_id}"]) for s in cands)  # type: ignore[type-var]
+            wanted: Dict[str, Set[str]] = {}
+            for s in cands:
+                wanted.setdefault(s.feed, set()).add(s.series_id)
+            try:
+                changed, why = updated_since(api_key, since, wanted)
+                if changed is None and why:
+                    notes.append(f"FRED:updates pre-pass skipped ({why}), full fetch")
+            except Exception as e:
+                notes.append(f"FRED:updates pre-pass failed ({type(e).__name__}), full fetch")
+        if changed is not None:
+            carry = {s.series_id for s in cands if s.series_id not in changed}
+            todo: List[FredSeries] = []
+            for s in items:
+                if s.series_id in carry:
+                    out[s.key] = prev[s.key]
+                    checked[f"FRED.{s.series_id}"] = stamp
+                else:
+                    todo.append(s)
+            items = todo
 
     for s in items:
-        j = get_json(
-            base,
-            {
-                "api_key": api_key,
-                "file_type": "json",
-                "series_id": s.series_id,
-                "observation_start": _iso(start),
-                "sort_order": "desc",
-                "limit": 10,
-            },
-        )
+        try:
+            j = get_json(
+                base,
+                {
+                    "api_key": api_key,
+                    "file_type": "json",
+                    "series_id": s.series_id,
+                    "observation_start": _iso(start),
+                    "sort_order": "desc",
+                    "limit": 10,
+                },
+            )
+        except Exception as e:
+            # 单个 series 失败不影响其余的；checked 不前进，下次照常重抓
+            notes.append(f"FRED:{s.series_id} fetch failed ({type(e).__name__})")
+            continue
         obs = j.get("observations", [])
         v: Optional[float] = None
         for o in obs:
@@ -56,6 +220,9 @@ def fetch_latest(api_key: str, items: List[FredSeries]) -> Tuple[Dict[str, float
             continue
 
         out[s.key] = v
+        if checked is not None:
+            checked[f"FRED.{s.series_id}"] = stamp
+            checked[f"FRED.{s.series_id}.fetched"] = stamp
 
     return out, notes
 
@@ -63,7 +230,7 @@ def fetch_latest(api_key: str, items: List[FredSeries]) -> Tuple[Dict[str, float
 def default_series() -> List[FredSeries]:
     # Minimal, stable, structural
     return [
-        FredSeries("L3.FRED.DGS10", "DGS10", "US 10Y Treasury"),
-        FredSeries("L3.FRED.DGS2", "DGS2", "US 2Y Treasury"),
-        FredSeries("L3.FRED.T10Y2Y", "T10Y2Y", "10Y-2Y Spread"),
+        FredSeries("L3.FRED.DGS10", "DGS10", "US 10Y Treasury", feed="macro"),
+        FredSeries("L3.FRED.DGS2", "DGS2", "US 2Y Treasury", feed="macro"),
+        FredSeries("L3.FRED.T10Y2Y", "T10Y2Y", "10Y-2Y Spread", feed="macro"),
     ]
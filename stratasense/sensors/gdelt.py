@@ -1,17 +1,50 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import hashlib
+import heapq
+import math
+import time
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from ..httpu import get_json
 
+# GDELT DOC API 限流约每 5 秒一次：本模块所有请求共用一个节流器
+MIN_INTERVAL = 5.0
+_last_call = 0.0
+
+
+def _get(base: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    global _last_call
+    wait = _last_call + MIN_INTERVAL - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    try:
+        return get_json(base, params)
+    finally:
+        # 从响应结束算起：慢响应之后也留足间隔
+        _last_call = time.monotonic()
+
 
 @dataclass(frozen=True)
 class GdeltQuery:
     key: str
     query: str
     label: str
+    # 流式聚合 key 的中间段：L1.GDELT.<topic>.COUNTRIES 等
+    topic: str = ""
+
+
+@dataclass(frozen=True)
+class StreamConfig:
+    max_articles: int = 1000
+    # DOC API 单次上限 250，且没有 offset：按时间切片分页
+    page_size: int = 250
+    # 切片数由 ceil(max_articles / page_size) 推出；最细到 1 小时
+    # 每页受 MIN_INTERVAL 节流：默认 1000 篇 = 4 页 + ToneChart ≈ 25 秒 / query
+    max_slices: int = 7 * 24
+    days: int = 7
 
 
 def _fmt(d: datetime) -> str:
@@ -33,7 +66,7 @@ def fetch_counts(items: List[GdeltQuery]) -> Tuple[Dict[str, float], List[str]]:
     t_1 = now - timedelta(days=14)
 
     for it in items:
-        j1 = get_json(
+        j1 = _get(
             base,
             {
                 "query": it.query,
@@ -44,7 +77,7 @@ def fetch_counts(items: List[GdeltQuery]) -> Tuple[Dict[str, float], List[str]]:
                 "enddatetime": _fmt(t1),
             },
         )
-        j0 = get_json(
+        j0 = _get(
             base,
             {
                 "query": it.query,
@@ -64,6 +97,243 @@ def fetch_counts(items: List[GdeltQuery]) -> Tuple[Dict[str, float], List[str]]:
     return out, notes
 
 
+class _TopK:
+    """Misra-Gries heavy hitters: at most `capacity` counters, whatever the input size."""
+
+    def __init__(self, capacity: int = 32) -> None:
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.total = 0
+
+    def add(self, item: str) -> None:
+        self.total += 1
+        if item in self.counts:
+            self.counts[item] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = 1
+        else:
+            for k in list(self.counts):
+                self.counts[k] -= 1
+                if self.counts[k] <= 0:
+                    del self.counts[k]
+
+    def top_share(self) -> float:
+        if not self.total or not self.counts:
+            return 0.0
+        return max(self.counts.values()) / self.total
+
+
+class _Distinct:
+    """K-minimum-values sketch: approximate distinct count in O(k) memory."""
+
+    def __init__(self, k: int = 64) -> None:
+        self.k = k
+        self._heap: List[float] = []  # max-heap (negated) of the k smallest hashes
+        self._seen: set = set()
+
+    @staticmethod
+    def _h(item: str) -> float:
+        d = hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(d, "big") / float(1 << 64)
+
+    def add(self, item: str) -> None:
+        h = self._h(item)
+        if h in self._seen:
+            return
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, -h)
+            self._seen.add(h)
+        elif h < -self._heap[0]:
+            old = -heapq.heapreplace(self._heap, -h)
+            self._seen.discard(old)
+            self._seen.add(h)
+
+    def estimate(self) -> float:
+        if len(self._heap) < self.k:
+            return float(len(self._heap))
+        return (self.k - 1) / (-self._heap[0])
+
+
+@dataclass
+class _ToneHist:
+    # GDELT ToneChart 的 bin 为整数 tone，截断到 [-10, 10]
+    bins: List[int] = field(default_factory=lambda: [0] * 21)
+
+    def add(self, tone: int, count: int) -> None:
+        self.bins[max(-10, min(10, tone)) + 10] += count
+
+    def total(self) -> int:
+        return sum(self.bins)
+
+    def mean(self) -> float:
+        n = self.total()
+        return sum((i - 10) * c for i, c in enumerate(self.bins)) / n if n else 0.0
+
+    def neg_share(self) -> float:
+        n = self.total()
+        return sum(self.bins[:10]) / n if n else 0.0
+
+
+@dataclass
+class ArticleAgg:
+    """Fixed-size fold of an article stream."""
+
+    articles: int = 0
+    countries: _Distinct = field(default_factory=_Distinct)
+    domains: _Distinct = field(default_factory=_Distinct)
+    languages: _TopK = field(default_factory=_TopK)
+    tone: _ToneHist = field(default_factory=_ToneHist)
+
+    def add(self, art: Dict[str, Any]) -> None:
+        self.articles += 1
+        c = (art.get("sourcecountry") or "").strip()
+        if c:
+            self.countries.add(c)
+        d = (art.get("domain") or "").strip().lower()
+        if d:
+            self.domains.add(d)
+        lang = (art.get("language") or "").strip()
+        if lang:
+            self.languages.add(lang)
+
+
+def _topic(it: GdeltQuery) -> str:
+    if it.topic:
+        return it.topic
+    # L1.GDELT.CONFLICT_RATIO -> CONFLICT
+    return it.key.split(".")[-1].replace("_RATIO", "")
+
+
+def stream_keys(it: GdeltQuery) -> List[str]:
+    t = _topic(it)
+    return [
+        f"L1.GDELT.{t}.ARTICLES",
+        f"L1.GDELT.{t}.COUNTRIES",
+        f"L1.GDELT.{t}.DOMAINS",
+        f"L1.GDELT.{t}.LANG_TOP_SHARE",
+        f"L4.GDELT.{t}.TONE_MEAN",
+        f"L4.GDELT.{t}.TONE_NEG_SHARE",
+    ]
+
+
+def _plan(cfg: StreamConfig) -> Tuple[int, int]:
+    """
+    (slices, per_slice): the cap is spread evenly over equal time slices,
+    so the whole window is sampled, not just its newest part.
+    """
+    slices = max(1, min(cfg.max_slices, math.ceil(cfg.max_articles / cfg.page_size)))
+    per_slice = min(cfg.page_size, math.ceil(cfg.max_articles / slices))
+    return slices, per_slice
+
+
+def _iter_articles(
+    base: str, it: GdeltQuery, cfg: StreamConfig, now: datetime, notes: List[str], pages: Dict[str, int]
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield articles page by page (newest slice first), at most per_slice
+    from each slice and cfg.max_articles in total.
+    Only one page is alive at a time. A failed page (rate limit reply,
+    bad JSON, timeout) is skipped and counted in pages["failed"].
+    """
+    slices, per_slice = _plan(cfg)
+    if slices * per_slice < cfg.max_articles:
+        notes.append(
+            f"GDELT:{_topic(it)} max_articles={cfg.max_articles} unreachable, "
+            f"capped at {slices * per_slice} ({slices} slices x {per_slice})"
+        )
+    step = timedelta(days=cfg.days) / slices
+    left = cfg.max_articles
+    saturated = 0
+    for i in range(slices):
+        if left <= 0:
+            break
+        t1 = now - step * i
+        t0 = t1 - step
+        try:
+            page = _get(
+                base,
+                {
+                    "query": it.query,
+                    "mode": "ArtList",
+                    "format": "json",
+                    "maxrecords": min(per_slice, left),
+                    "sort": "DateDesc",
+                    "startdatetime": _fmt(t0),
+                    "enddatetime": _fmt(t1),
+                },
+            )
+        except Exception:
+            pages["failed"] += 1
+            continue
+        pages["ok"] += 1
+        arts = page.get("articles", []) or []
+        if len(arts) >= per_slice:
+            saturated += 1
+        for a in arts[:left]:
+            left -= 1
+            yield a
+    if saturated:
+        notes.append(f"GDELT:{_topic(it)} {saturated}/{slices} slice(s) sampled at {per_slice}, counts are lower bounds")
+
+
+def fetch_aggregates(items: List[GdeltQuery], cfg: Optional[StreamConfig] = None) -> Tuple[Dict[str, float], List[str]]:
+    """
+    Streaming mode: page through ArtList up to cfg.max_articles per query and
+    fold each article into fixed-size aggregates (count, distinct countries /
+    domains, language mix) plus the ToneChart histogram.
+    Shadow signal only, same as fetch_counts.
+    """
+    cfg = cfg or StreamConfig()
+    notes: List[str] = []
+    out: Dict[str, float] = {}
+
+    base = "https://api.gdeltproject.org/api/v2/doc/doc"
+    now = datetime.now(timezone.utc)
+
+    for it in items:
+        agg = ArticleAgg()
+        pages = {"ok": 0, "failed": 0}
+        for art in _iter_articles(base, it, cfg, now, notes, pages):
+            agg.add(art)
+
+        try:
+            tc = _get(
+                base,
+                {
+                    "query": it.query,
+                    "mode": "ToneChart",
+                    "format": "json",
+                    "startdatetime": _fmt(now - timedelta(days=cfg.days)),
+                    "enddatetime": _fmt(now),
+                },
+            )
+        except Exception as e:
+            notes.append(f"GDELT:{_topic(it)} tonechart failed ({type(e).__name__})")
+            tc = {}
+        for b in tc.get("tonechart", []) or []:
+            try:
+                agg.tone.add(int(b.get("bin")), int(b.get("count")))
+            except Exception:
+                continue
+
+        k_art, k_cty, k_dom, k_lang, k_tone, k_neg = stream_keys(it)
+        if pages["failed"]:
+            notes.append(f"GDELT:{_topic(it)} {pages['failed']} page(s) failed, aggregates are partial")
+        # 一页都没拿到：不写 0（否则会被当成结构变化），让这些 key 缺席
+        if pages["ok"]:
+            out[k_art] = float(agg.articles)
+            out[k_cty] = round(agg.countries.estimate(), 1)
+            out[k_dom] = round(agg.domains.estimate(), 1)
+            out[k_lang] = round(agg.languages.top_share(), 3)
+        if agg.tone.total():
+            out[k_tone] = round(agg.tone.mean(), 3)
+            out[k_neg] = round(agg.tone.neg_share(), 3)
+        elif tc:
+            notes.append(f"GDELT:{_topic(it)} no tonechart data")
+
+    return out, notes
+
+
 def default_queries() -> List[GdeltQuery]:
     # Low weight, anomaly hint only
     return [
@@ -71,10 +341,12 @@ def default_queries() -> List[GdeltQuery]:
             "L1.GDELT.CONFLICT_RATIO",
             "conflict OR war OR military",
             "Global conflict news ratio (7d/prev7d)",
+            topic="CONFLICT",
         ),
         GdeltQuery(
             "L1.GDELT.PROTEST_RATIO",
             "protest OR strike OR riot",
             "Global protest news ratio (7d/prev7d)",
+            topic="PROTEST",
         ),
     ]
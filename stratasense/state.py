@@ -1,13 +1,21 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Any, Dict, Tuple
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# 认知分层：key 形如 L3.FRED.DGS10 = <layer>.<source>.<series>
+LAYERS = ("L1", "L2", "L3", "L4", "L5")
+# 不带 L1..L5 前缀的旧 key 统一归到这一组
+UNLAYERED = "(unlayered)"
 
 
 @dataclass
 class State:
     # key -> last numeric value
     last: Dict[str, float]
+    # source (FRED / EIA / ...) -> ISO time it was last actually fetched
+    checked: Dict[str, str] = field(default_factory=dict)
+    _index: Optional["KeyIndex"] = field(default=None, init=False, repr=False, compare=False)
 
     @staticmethod
     def from_obj(obj: Dict[str, Any]) -> "State":
@@ -19,10 +27,114 @@ class State:
                     out[str(k)] = float(v)
                 except Exception:
                     continue
-        return State(last=out)
+        checked = obj.get("checked", {}) if isinstance(obj, dict) else {}
+        if not isinstance(checked, dict):
+            checked = {}
+        return State(last=out, checked={str(k): str(v) for k, v in checked.items()})
 
     def to_obj(self) -> Dict[str, Any]:
-        return {"last": self.last}
+        obj: Dict[str, Any] = {"last": self.last}
+        if self.checked:
+            obj["checked"] = self.checked
+        return obj
+
+    def index(self) -> "KeyIndex":
+        # 每个 State 只建一次（O(n)，不排序）；State 视为构造后不再修改
+        if self._index is None:
+            self._index = KeyIndex(self.last.keys())
+        return self._index
+
+    def select(self, prefixes: Optional[Sequence[str]]) -> "State":
+        """Slice of this state whose keys match any prefix (None = everything)."""
+        if not prefixes:
+            return State(last=dict(self.last))
+        # 走前缀索引：只遍历命中的 layer / source 桶
+        return State(last={k: self.last[k] for k in self.index().select(prefixes)})
+
+
+def split_key(key: str) -> Tuple[str, str, str]:
+    """
+    L3.FRED.DGS10 -> ("L3", "FRED", "DGS10")
+    首段不是 L1..L5 的旧 key 统一归入 UNLAYERED：OLD.X -> (UNLAYERED, "", "OLD.X")。
+    """
+    parts = key.split(".", 2)
+    if parts[0] not in LAYERS:
+        return UNLAYERED, "", key
+    while len(parts) < 3:
+        parts.append("")
+    return parts[0], parts[1], parts[2]
+
+
+def parse_prefixes(raw: Optional[Iterable[str]]) -> List[str]:
+    """
+    --layer L2 / --layer L1,L3 / --layer L3.FRED -> ["L2"] / ["L1", "L3"] / ["L3.FRED"]
+    """
+    out: List[str] = []
+    for item in raw or []:
+        for p in str(item).split(","):
+            p = p.strip().strip(".")
+            if not p:
+                continue
+            # key 全部大写：l3.fred -> L3.FRED
+            p = p.upper()
+            if p not in out:
+                out.append(p)
+    return out
+
+
+def match_prefix(key: str, prefixes: Optional[Sequence[str]]) -> bool:
+    if not prefixes:
+        return True
+    for p in prefixes:
+        if key == p or key.startswith(p + "."):
+            return True
+    return False
+
+
+class KeyIndex:
+    """
+    Prefix index over state keys: layer -> source -> keys.
+    Built in one unsorted pass; prefix selection only walks the matching
+    buckets, and sorting happens per layer only when grouping for output.
+    """
+
+    def __init__(self, keys: Iterable[str]) -> None:
+        self._tree: Dict[str, Dict[str, List[str]]] = {}
+        for k in keys:
+            layer, source, _ = split_key(k)
+            self._tree.setdefault(layer, {}).setdefault(source, []).append(k)
+
+    def layers(self) -> List[str]:
+        # L1..L5 在前（固定顺序），无层级的旧 key 最后
+        return [l for l in LAYERS + (UNLAYERED,) if l in self._tree]
+
+    def keys(self, layer: Optional[str] = None, source: Optional[str] = None) -> Iterator[str]:
+        layers = [layer] if layer is not None else self.layers()
+        for l in layers:
+            srcs = self._tree.get(l, {})
+            names = [source] if source is not None else list(srcs)
+            for s in names:
+                yield from srcs.get(s, [])
+
+    def select(self, prefixes: Optional[Sequence[str]]) -> List[str]:
+        if not prefixes:
+            return list(self.keys())
+        out: List[str] = []
+        seen = set()
+        for p in prefixes:
+            layer, source, series = split_key(p)
+            for k in self.keys(layer, source or None):
+                if k in seen or (series and not match_prefix(k, [p])):
+                    continue
+                seen.add(k)
+                out.append(k)
+        return out
+
+    def group(self, sort: bool = True) -> Iterator[Tuple[str, List[str]]]:
+        """(layer, keys) in layer order; sort=False keeps insertion order."""
+        for l in self.layers():
+            keys = list(self.keys(l))
+            yield l, sorted(keys) if sort else keys
 
 
 def diff_state(prev: State, cur: State) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, Tuple[float, float]]]:
@@ -49,3 +161,19 @@ def diff_state(prev: State, cur: State) -> Tuple[Dict[str, float], Dict[str, flo
             removed[k] = ov
 
     return added, removed, changed
+
+
+def diff_by_layer(
+    prev: State, cur: State
+) -> Dict[str, Tuple[Dict[str, float], Dict[str, float], Dict[str, Tuple[float, float]]]]:
+    """
+    Same as diff_state, split per layer: layer -> (added, removed, changed).
+    """
+    added, removed, changed = diff_state(prev, cur)
+    out: Dict[str, Tuple[Dict[str, float], Dict[str, float], Dict[str, Tuple[float, float]]]] = {}
+    for bucket, pos in ((added, 0), (removed, 1), (changed, 2)):
+        for k, v in bucket.items():
+            layer = split_key(k)[0]
+            row = out.setdefault(layer, ({}, {}, {}))
+            row[pos][k] = v  # type: ignore[index]
+    return out